@@ -1,11 +1,18 @@
 import numpy as np
 import pandas as pd
-import math as math
 import matplotlib.pyplot as plt
-import scipy.optimize
+from matplotlib import animation
+from matplotlib.collections import LineCollection
+from IPython.display import HTML
 import time
+from functools import lru_cache
 
 
+# sin and cos lookup tables for the 0 to 360 degree sweep of theta2 (1 degree steps)
+THETA2 = np.arange(0, 361)
+COS_THETA2 = np.cos(np.radians(THETA2))
+SIN_THETA2 = np.sin(np.radians(THETA2))
+
 
 def check_valid(l1, l2, l3, l4):
     """Check if the entered link lengths meet the constraint specified in the project. 
@@ -23,9 +30,11 @@ def check_valid(l1, l2, l3, l4):
     
     Returns
     -------
-    boolean True/False 
+    validity : boolean True/False 
         True: link lengths are valid.
         False: link lengths are not valid.
+    links : tuple of float or None
+        Link lengths converted to floats (l1, l2, l3, l4) if they are valid, otherwise None.
     """
     
     # convert link lengths to floats
@@ -34,39 +43,115 @@ def check_valid(l1, l2, l3, l4):
     l3 = float(l3)      # link 3
     l4 = float(l4)      # link 4
     
-    links = [l1,l2,l3,l4]
-    
     # find maximum and minimum link lengths
-    link_max = max(links)
-    link_min = min(links)
-    pos_max = links.index(link_max)
-    pos_min = links.index(link_min)
+    link_max = max(l1, l2, l3, l4)
+    link_min = min(l1, l2, l3, l4)
     
-    # create list to store max and min lengths
-    min_max = [link_min, link_max]
+    # check if link lengths are valid given constraint
+    # (shortest + longest <= sum of the other two links, i.e. 2*(shortest + longest) <= sum of all links)
+    if 2*(link_min + link_max) <= l1 + l2 + l3 + l4:
+        return True, (l1, l2, l3, l4)
     
-    # convert links list to only links that are not max or min links
-    del links[pos_max]
+    return False, None
+
     
-    if pos_max < pos_min:
-        del links[pos_min-1]
-        
-    elif pos_max >= pos_min:
-        del links[pos_min]
+
+def _solve_linkage(l1, l2, l3, l4):
+    """Solve theta4 and theta3 over the full theta2 sweep using the closed-form solution of Freudenstein's equation.
     
-    # check if link lengths are valid given constraint
-    if sum(min_max) <= sum(links):
-        return True
+    Parameters
+    ----------
+    l1, l2, l3, l4 : float or ndarray
+        Link lengths. Scalars solve one linkage; (K, 1) columns solve K linkages at once by broadcasting against theta2.
+    
+    Returns
+    -------
+    theta4 : ndarray, shape (361,) or (K, 361)
+        Theta4 in radians for each value of theta2 in degrees.
+    theta3 : ndarray, shape (361,) or (K, 361)
+        Theta3 in radians, laid out like theta4.
+    valid : ndarray of bool, shape (1,) or (K, 1)
+        False where the motion cannot be calculated due to geometry constraints. Theta values there are meaningless.
+    """
+    
+    # define parameters L1, L2, and L3 from link lengths
+    L1 = l1/l4
+    L2 = l1/l2
+    L3 = (l1**2 + l2**2 - l3**2 + l4**2)/2/l2/l4
+    
+    # minimum and maximum values for theta4 only exist if the acos arguments are within [-1, 1]
+    theta4_min_cos = ((l2 - l3)**2 - l1**2 - l4**2)/(2*l1*l4)
+    theta4_max_cos = ((l2 + l3)**2 - l1**2 - l4**2)/(2*l1*l4)
+    valid = (np.abs(theta4_min_cos) <= 1) & (np.abs(theta4_max_cos) <= 1)
+    theta4_max = np.arccos(np.clip(theta4_max_cos, -1, 1))
+    
+    c2 = COS_THETA2
+    s2 = SIN_THETA2
+    
+    # expanding cos(theta2 - theta4) turns freudenstein's equation into A*sin(theta4) + B*cos(theta4) = C
+    A = -s2
+    B = L2 - c2
+    C = L1*c2 - L3
+    
+    # closed-form solution: theta4 = phi +/- acos(C/R), where R and phi are the amplitude and phase of A*sin + B*cos
+    R = np.hypot(A, B)
+    phi = np.arctan2(A, B)
+    
+    # when l1 == l2, R and C are both 0 at theta2 = 0 and 360 degrees for linkages such as kites (l3 == l4):
+    # link 2 folds onto link 1 and any theta4 solves the equation there
+    degenerate = (R < 1e-12) & (np.abs(C) < 1e-12)
+    
+    # the linkage cannot be assembled at any theta2 where |C| > R (written without dividing so degenerate samples pass)
+    valid = valid & np.all(np.abs(C) <= R + 1e-12, axis=-1, keepdims=True)
     
-    elif sum(min_max) > sum(links):
-        return False
+    # C/R is only 0/0 at degenerate samples, which np.where replaces
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = np.arccos(np.clip(np.where(degenerate, 0, C/R), -1, 1))
+    
+    # start on the assembly branch closest to theta4_max (judged at theta2 = 1 degree when theta2 = 0 is degenerate)
+    theta4_open = phi + gamma
+    theta4_cross = phi - gamma
+    
+    wrap = lambda angle: (angle + np.pi) % (2*np.pi) - np.pi
+    
+    open_closer = np.abs(wrap(theta4_open - theta4_max)) <= np.abs(wrap(theta4_cross - theta4_max))
+    open_first = np.take_along_axis(open_closer, np.where(degenerate[..., :1], 1, 0), axis=-1)
+    
+    # the two branches touch at change points (e.g. theta2 = 180 degrees for kites). switch branches there whenever
+    # that follows the motion more smoothly, judged against a straight-line prediction from the previous two angles
+    predict_open = 2*theta4_open[..., 1:-1] - theta4_open[..., :-2]
+    predict_cross = 2*theta4_cross[..., 1:-1] - theta4_cross[..., :-2]
+    keep = np.abs(wrap(theta4_open[..., 2:] - predict_open)) + np.abs(wrap(theta4_cross[..., 2:] - predict_cross))
+    swap = np.abs(wrap(theta4_cross[..., 2:] - predict_open)) + np.abs(wrap(theta4_open[..., 2:] - predict_cross))
+    switch = (swap < keep) & ~degenerate[..., :-2] & ~degenerate[..., 1:-1] & ~degenerate[..., 2:]
+    switched = np.concatenate([np.zeros_like(switch[..., :2]), np.cumsum(switch, axis=-1) % 2 == 1], axis=-1)
+    
+    theta4 = np.where(open_first ^ switched, theta4_open, theta4_cross)
+    
+    # at a degenerate theta2, carry over theta4 from the neighbouring angle so the motion stays continuous
+    theta4[..., 0] = np.where(degenerate[..., 0], theta4[..., 1], theta4[..., 0])
+    theta4[..., -1] = np.where(degenerate[..., -1], theta4[..., -2], theta4[..., -1])
+    
+    # theta4 does not fall on the lookup table, so its sin and cos are evaluated once here and reused below
+    c4 = np.cos(theta4)
+    s4 = np.sin(theta4)
+    
+    # calculate theta3 values for every value of theta4 and theta2
+    theta3_sin = (l4*s4 - l2*s2)/l3
+    valid = valid & np.all(np.abs(theta3_sin) <= 1, axis=-1, keepdims=True)
+    
+    theta3_base = np.arcsin(np.clip(theta3_sin, -1, 1))
 
+    # cos(360 - theta2) = cos(theta2) and cos(180 - theta4) = -cos(theta4)
+    theta3 = np.where(l2*c2 > l1 + l4*c4, np.pi - theta3_base, theta3_base)
     
+    return theta4, theta3, valid
 
-def calculate_linkage(l1, l2, l3, l4):
+
+def calculate_linkage(l1, l2, l3, l4, pause=1.0):
     """Calculate positions of links for a mechanism rotation of 360 degrees. Generate animation to show mechanism rotation.
     
-    Each link position is defined by an angle (theta1, theta2, theta3, and theta4). This function uses Freudenstein's equation to solve for theta4 given a value of theta2 between 0 and 360 degrees (one full rotation). Theta4 and theta2 are then used to solve for theta3 so that each link will have a stored list of theta values that define their position during a full rotation of theta2. These lists of theta values are used to animate the link positions. 
+    Each link position is defined by an angle (theta1, theta2, theta3, and theta4). This function uses the closed-form solution of Freudenstein's equation to solve for theta4 at every value of theta2 between 0 and 360 degrees (one full rotation). Theta4 and theta2 are then used to solve for theta3 so that each link will have a stored list of theta values that define their position during a full rotation of theta2. These lists of theta values are used to animate the link positions. 
     
     Parameters
     ----------
@@ -78,6 +163,8 @@ def calculate_linkage(l1, l2, l3, l4):
         Entered length of link 3.
     l4 : int or float
         Entered length of link 4.
+    pause : int or float, optional
+        Scale factor for the pause after the geometry error message. Use 0 to skip the pause.
     
     Returns
     -------
@@ -89,58 +176,23 @@ def calculate_linkage(l1, l2, l3, l4):
     Code used to generate and display the animation was drawn from this tutorial by Jeffrey Kantor (https://jckantor.github.io/CBE30338/A.03-Animation-in-Jupyter-Notebooks.html).
     """
     
-    # define parameters L1, L2, and L3 from link lengths (to be used later)
-    L1 = l1/l4
-    L2 = l1/l2
-    L3 = (l1**2 + l2**2 - l3**2 + l4**2)/2/l2/l4
+    # solve for theta4 and theta3 over one full rotation of theta2
+    theta4, theta3, valid = _solve_linkage(l1, l2, l3, l4)
 
-    # calculate minimum and maximum values for theta4
-    try:
-        theta4_min = math.degrees(math.acos( ((l2 - l3)**2 - l1**2 - l4**2)/(2*l1*l4) ))
-        theta4_max = math.degrees(math.acos( ((l2 + l3)**2 - l1**2 - l4**2)/(2*l1*l4) ))
-    except:
+    if not np.all(valid):
         print('')
         print('oops! due to geometry constraints, we cannot calculate the motion for this set of links.')
-        time.sleep(2.75)
+        time.sleep(2.75*pause)
         print('')
         print('please enter a new set of link lengths.')
         print('')
         linkage = False
         return linkage
 
-    # create empty lists for theta4 and theta3
-    theta4 = []
-    theta3 = []
-
-    # use root solver to solve for theta4 given value of theta2 and initial guess of theta4_max
-    for theta2 in range(0, 361):
-        
-        # freudenstein's equation for four-bar linkage mechanisms 
-        freudenstein = lambda theta4 : L3 + L2*math.cos(math.radians(theta4)) - L1*math.cos(math.radians(theta2)) - \
-            math.cos(math.radians(theta2 - theta4))
-
-        theta4_sol = scipy.optimize.fsolve(freudenstein, theta4_max) 
-
-        theta4.append(theta4_sol)
-        
-        # calculate theta3 values for each value of theta4 and theta2
-        try:
-            
-            if l2*math.cos(math.radians(360-theta2)) > l1-l4*math.cos(math.radians(180-theta4[theta2])):
-                theta3.append(180-math.asin( (l4*math.sin(math.radians(theta4[theta2])) - l2*math.sin(math.radians(theta2)))/l3 ))
-                
-            else:
-                theta3.append(math.asin( (l4*math.sin(math.radians(theta4[theta2])) - l2*math.sin(math.radians(theta2)))/l3 ))
-        
-        except:
-            print('')
-            print('oops! due to geometry constraints, we cannot calculate the motion for this set of links.')
-            time.sleep(2.75)
-            print('')
-            print('please enter a new set of link lengths.')
-            print('')
-            linkage = False
-            return linkage
+    c2 = COS_THETA2
+    s2 = SIN_THETA2
+    c4 = np.cos(theta4)
+    s4 = np.sin(theta4)
     
     # set up plot for animation
     # set axis limits
@@ -149,17 +201,9 @@ def calculate_linkage(l1, l2, l3, l4):
     y_neg = -1.25*l2
     y_pos = 1.25*l4
 
-    if x_neg > y_neg:
-        y_neg = x_neg
-        
-    else:
-        x_neg = y_neg
-        
-    if x_pos >  y_pos:
-        y_pos = x_pos
-        
-    else:
-        x_pos = y_pos
+    # use the same limits on both axes so the plot stays square
+    x_neg = y_neg = min(x_neg, y_neg)
+    x_pos = y_pos = max(x_pos, y_pos)
 
     # create a figure and axes
     fig = plt.figure(figsize=(12,5))
@@ -169,54 +213,125 @@ def calculate_linkage(l1, l2, l3, l4):
     ax.set_ylim([y_neg, y_pos])
     ax.set_aspect('equal', 'box')
 
-    # create objects that will change in the animation
-    # these are initially empty, and will be given new values for each frame in the animation
-    line1, = ax.plot([], [], 'tab:brown', lw=7)     # ax.plot returns a list of 2D line objects
-    line2, = ax.plot([], [], 'tab:cyan', lw=7)
-    line3, = ax.plot([], [], 'tab:pink', lw=7)
-    line4, = ax.plot([], [], 'tab:green', lw=7)
+    # precompute the segment ((x start, y start), (x end, y end)) of every link for every frame
+    # so drawframe only has to look them up
+    x2 = l2*c2
+    y2 = l2*s2
+    x4 = l1 + l4*c4
+    y4 = l4*s4
+    zero = np.zeros_like(x2)
+    ground = np.full_like(x2, l1)
 
-    # animation function. This is called sequentially
-    def drawframe(n):
-        
-        x1 = np.array([0, l1])
-        y1 = np.array([0, 0])
-        x2 = np.array([0, l2*math.cos(math.radians(n))])
-        y2 = np.array([0, l2*math.sin(math.radians(n))])
-        x3 = np.array([l2*math.cos(math.radians(n)), l1 + l4*math.cos(math.radians(theta4[n]))])
-        y3 = np.array([l2*math.sin(math.radians(n)), l4*math.sin(math.radians(theta4[n]))])
-        x4 = np.array([l1, l1 + l4*math.cos(math.radians(theta4[n]))])
-        y4 = np.array([0, l4*math.sin(math.radians(theta4[n]))])
-        line1.set_data(x1, y1)
-        line2.set_data(x2, y2)
-        line3.set_data(x3, y3)
-        line4.set_data(x4, y4)
-
-        return (line1,line2,line3,line4)
+    segments = np.stack([
+        np.stack([zero, zero, ground, zero], axis=-1),      # link 1
+        np.stack([zero, zero, x2, y2], axis=-1),            # link 2
+        np.stack([x2, y2, x4, y4], axis=-1),                # link 3
+        np.stack([ground, zero, x4, y4], axis=-1),          # link 4
+    ], axis=1).reshape(-1, 4, 2, 2)
+
+    # create one collection holding all four links for each frame of the animation
+    # the axis limits are fixed above, so the collections do not need to update the data limits
+    link_colors = ['tab:brown', 'tab:cyan', 'tab:pink', 'tab:green']
+    frames = [[ax.add_collection(LineCollection(segments[n], colors=link_colors, linewidths=7, capstyle='projecting'),
+                                 autolim=False)] for n in range(360)]
 
     # close plot of last frame of animation
     plt.close()
 
     # create animation
-    from matplotlib import animation
-
+    # all frames are drawn up front, so no python callback runs per frame when the animation is rendered
     # blit=True re-draws only the parts that have changed.
-    anim = animation.FuncAnimation(fig, drawframe, frames=360, interval=20, blit=True)
+    anim = animation.ArtistAnimation(fig, frames, interval=20, blit=True)
 
     # display animation
-    from IPython.display import HTML
+    linkage = HTML(anim.to_jshtml(fps=50))
+    
+    return linkage
+
+
+def calculate_linkage_batch(l1, l2, l3, l4):
+    """Calculate link positions for many sets of link lengths at once, without generating animations.
+    
+    Uses the same solver as calculate_linkage, broadcast over every set of link lengths and every value of theta2 between 0 and 360 degrees. Useful for sweeping through many candidate linkages.
+    
+    Parameters
+    ----------
+    l1 : array_like of float, shape (K,)
+        Lengths of link 1.
+    l2 : array_like of float, shape (K,)
+        Lengths of link 2.
+    l3 : array_like of float, shape (K,)
+        Lengths of link 3.
+    l4 : array_like of float, shape (K,)
+        Lengths of link 4.
+    
+    Returns
+    -------
+    theta4 : ndarray, shape (K, 361)
+        Theta4 in radians for each set of link lengths (rows) and each value of theta2 in degrees (columns).
+    theta3 : ndarray, shape (K, 361)
+        Theta3 in radians, laid out like theta4.
+        
+    Rows for sets of link lengths whose motion cannot be calculated due to geometry constraints are filled with nan.
+    """
+    
+    # link lengths become (K, 1) columns so they broadcast against the (361,) theta2 sweep
+    l1 = np.asarray(l1, dtype=float).reshape(-1, 1)
+    l2 = np.asarray(l2, dtype=float).reshape(-1, 1)
+    l3 = np.asarray(l3, dtype=float).reshape(-1, 1)
+    l4 = np.asarray(l4, dtype=float).reshape(-1, 1)
     
-    linkage = HTML(anim.to_html5_video())
+    theta4, theta3, valid = _solve_linkage(l1, l2, l3, l4)
+    
+    # mask sets of link lengths that failed a geometry check
+    theta4 = np.where(valid, theta4, np.nan)
+    theta3 = np.where(valid, theta3, np.nan)
+    
+    return theta4, theta3
+
+
+class _LinkageError(Exception):
+    """Raised by _cached_linkage when calculate_linkage cannot solve the linkage for the entered link lengths."""
+
+
+# each cached animation is several MB of html, so only the last few are kept
+@lru_cache(maxsize=4)
+def _cached_linkage(l1, l2, l3, l4):
+    """Return the linkage animation for a set of link lengths, reusing it if the same lengths were entered before.
+    
+    Parameters
+    ----------
+    l1, l2, l3, l4 : float
+        Link lengths, rounded by the caller so that equal entries share a cache entry.
+    
+    Returns
+    -------
+    linkage : html animation
+        Animation generated by calculate_linkage.
+    
+    Raises
+    ------
+    _LinkageError
+        If calculate_linkage cannot solve the linkage. Failures are raised rather than returned so they are not cached
+        and the geometry message is shown again if the same lengths are re-entered. The message is printed without
+        a pause, so the pause does not become part of the cache key; the caller pauses after catching the error.
+    """
+    
+    linkage = calculate_linkage(l1, l2, l3, l4, pause=0)
+    
+    if not linkage:
+        raise _LinkageError('linkage cannot be solved for these link lengths')
     
     return linkage
     
 
-def four_bar_linkage():
+def four_bar_linkage(pause=1.0):
     """Main function to run four-bar linkage simulator. 
     
     Parameters
     ----------
-    None.
+    pause : int or float, optional
+        Scale factor for the pauses between print statements. Use 0 to run without pauses.
     
     Returns
     -------
@@ -225,8 +340,8 @@ def four_bar_linkage():
     """
     
         
-    t = 2.75    # standard pause time between print statements
-    ts = 1      # shorter pause
+    t = 2.75*pause    # standard pause time between print statements
+    ts = 1*pause      # shorter pause
 
     # start info
     print('welcome to the four-bar linkage simulator!')
@@ -277,11 +392,11 @@ def four_bar_linkage():
             print('we will now check if we have a valid four-bar linkage:')
             time.sleep(ts)
             print('calculating ...')
-            time.sleep(1)
+            time.sleep(ts)
             print('')
             
             # check validity of link lengths
-            validity = check_valid(l1, l2, l3, l4)
+            validity, links = check_valid(l1, l2, l3, l4)
             
             # proceed if links are valid; return to entering link lengths if invalid
             if validity:
@@ -307,13 +422,16 @@ def four_bar_linkage():
         time.sleep(ts)
         print('preparing four-bar linkage ... (this may take a few seconds)')
         
-        # convert link lengths to floats for use in calculate_linkage function
-        l1 = float(l1)
-        l2 = float(l2)
-        l3 = float(l3)
-        l4 = float(l4)
+        # use the link lengths converted to floats by check_valid in calculate_linkage function
+        l1, l2, l3, l4 = links
 
-        linkage = calculate_linkage(l1, l2, l3, l4)
+        try:
+            linkage = _cached_linkage(round(l1, 6), round(l2, 6), round(l3, 6), round(l4, 6))
+        
+        except _LinkageError:
+            # give the user time to read the geometry message before entering new link lengths
+            time.sleep(t)
+            linkage = False
         
         # if animation is generated, end function and return linkage. if error, return to entering link lengths
         if linkage: